@@ -9,6 +9,7 @@ from itertools import accumulate
 
 from typing import Dict, List, Tuple, Union, cast, Any, Optional
 import copy
+import math
 
 from xgboost.sklearn import XGBClassifier, XGBRegressor
 import numpy as np
@@ -48,9 +49,9 @@ class BinnedVar:
         # loop over the bin intervals (start, stop, value)
         for el in self.levels:
             # missing or override
-            if el.ll is np.nan:
+            if math.isnan(el.ll):
                 # missing
-                if el.ul is np.nan:
+                if math.isnan(el.ul):
                     res[np.isnan(x)] = el.value
                 # override
                 else:
@@ -220,7 +221,7 @@ class BaseBoostCard(BaseEstimator):
                     # adding them to the _bins list
                     yhat = stump.transform(x, pos)
                     # filter X to only where it is in selection
-                    f = sel.in_selection(X[[constraint.name]]).reshape(-1)
+                    f = sel.in_selection(X[constraint.name].values)
                     clf.fit(X[[constraint.name]][f], yhat[f])
                     intervals += util.sklearn_tree_to_bins(clf.tree_, values=sel.values)
 
@@ -18,6 +18,7 @@ class Blueprint:
 
     def __init__(self, selections: List[FittedSelection], mono: Optional[int] = 0):
         self.selections = sorted(selections, key=attrgetter("sort_value"), reverse=True)
+        self.selection_set = SelectionSet(self.selections)
         self.mono = mono
     
     def __len__(self) -> int:
@@ -88,7 +89,7 @@ class Constraint:
 
         # Check Override Selections
         overrides = cast(List[Override], self.filter_types(self.selections, Override))
-        vals = [e.value for e in overrides]
+        vals = [e.override for e in overrides]
         if len(set(vals)) != len(vals):
             raise ValueError("Override selections must have unique values.")
 
@@ -209,13 +210,8 @@ class Constraint:
         for blueprint in self._blueprints:
             #print("New Blueprint!")
 
-            fitted_sels = blueprint.selections
-
-            # start with a vector of np.nan to fill with the transformed results
-            res = np.full_like(x, np.nan, dtype="float")
-            for selection in fitted_sels:
-                #print(f"  {type(selection.selection)}")
-                res = selection.transform(x, res, clamp)
+            # apply every selection of the blueprint in a single sweep over x
+            res = blueprint.selection_set.transform(x, clamp)
 
             out.append(res.reshape(-1, 1))
 
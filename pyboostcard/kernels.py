@@ -0,0 +1,177 @@
+"""Fused, single-pass kernels for selection transforms, compiled with numba or evaluated with numexpr when available"""
+from typing import Any, Callable, Dict, Tuple
+import numpy as np
+
+try:
+    from numba import njit, prange
+
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+try:
+    import numexpr as ne
+
+    HAS_NUMEXPR = True
+except ImportError:
+    HAS_NUMEXPR = False
+
+# below this many elements the thread pool costs more than it saves
+PARALLEL_THRESHOLD = 50_000
+# elements handed to each parallel task
+PARALLEL_CHUNK = 16_384
+# below this many elements numexpr's thread dispatch costs more than its blocked evaluation saves; numexpr works in
+# 4096-element blocks, so this leaves a few blocks per thread and stays under TILE_SIZE so full tiles can use it
+NUMEXPR_THRESHOLD = 32_768
+# elements per block on the NumPy path, 512 KiB of float64 so a block stays in L2 across every selection
+# while keeping the per-block Python overhead small
+TILE_SIZE = 65_536
+# elements checked between early-exit tests when scanning for missing values
+NAN_SCAN_CHUNK = 4096
+
+FILL_KERNEL: Any = None
+SELECTION_SET_KERNEL: Any = None
+
+# selection kinds passed to the kernels
+KIND_INTERVAL = 0
+KIND_OVERRIDE = 1
+KIND_MISSING = 2
+KIND_ALWAYS = 3
+
+
+INTERVAL_EXPRESSIONS: Dict[Tuple[bool, bool], str] = {
+    (False, False): "m & (x > lo) & (x < hi)",
+    (False, True): "m & (x > lo) & (x <= hi)",
+    (True, False): "m & (x >= lo) & (x < hi)",
+    (True, True): "m & (x >= lo) & (x <= hi)",
+}
+
+
+def interval_mask_numexpr(x: np.ndarray, mask: np.ndarray, lo: float, hi: float, bounds: Tuple[bool, bool]) -> np.ndarray:
+    """Return mask & (x within lo, hi) computed in one blocked, multi-threaded numexpr pass"""
+    return ne.evaluate(INTERVAL_EXPRESSIONS[bounds], local_dict={"x": x, "m": mask, "lo": lo, "hi": hi})
+
+
+def fill_numexpr(f: np.ndarray, x: np.ndarray, result: np.ndarray, mask: np.ndarray, replace: float, use_x: bool) -> None:
+    """Store x (or replace) into result where f is set and clear those slots from mask, both in place"""
+    src = x if use_x else np.float64(replace)
+    ne.evaluate("where(f, s, r)", local_dict={"f": f, "s": src, "r": result}, out=result)
+    ne.evaluate("m & ~f", local_dict={"m": mask, "f": f}, out=mask)
+
+
+def _has_nan_numpy(a: np.ndarray) -> bool:
+    for start in range(0, a.shape[0], NAN_SCAN_CHUNK):
+        if np.isnan(a[start : start + NAN_SCAN_CHUNK]).any():
+            return True
+    return False
+
+
+_has_nan: Callable[[np.ndarray], bool] = _has_nan_numpy
+
+
+def has_nan(a: np.ndarray) -> bool:
+    """Return True as soon as a missing value is found, scanning in chunks rather than building a full mask"""
+    return _has_nan(a.reshape(-1))
+
+
+if HAS_NUMBA:
+
+    @njit(cache=True)
+    def _has_nan_numba(a):  # type: ignore
+        # the inner loop has no early exit so it vectorizes, the check between chunks bounds the wasted work
+        n = a.shape[0]
+        for start in range(0, n, NAN_SCAN_CHUNK):
+            found = False
+            for i in range(start, min(start + NAN_SCAN_CHUNK, n)):
+                found |= a[i] != a[i]
+            if found:
+                return True
+        return False
+
+    _has_nan = _has_nan_numba
+
+    @njit(cache=True)
+    def _hit(xi, kind, lo, hi, closed_lo, closed_hi):  # type: ignore
+        if kind == KIND_INTERVAL:
+            return (xi > lo or (closed_lo and xi == lo)) and (xi < hi or (closed_hi and xi == hi))
+        elif kind == KIND_OVERRIDE:
+            return xi == lo
+        elif kind == KIND_MISSING:
+            return xi != xi
+        return True
+
+    @njit(cache=True, boundscheck=False)
+    def _fill_serial(x, result, mask, kind, lo, hi, closed_lo, closed_hi, ll, ul, replace, use_x):  # type: ignore
+        # kind and the bound flags are loop invariant, so the compiler hoists the branches on them out of the loop.
+        # Intervals clamp x in place and re-test before storing, mirroring FittedSelection.transform_with_mask
+        for i in range(x.shape[0]):
+            if not mask[i]:
+                continue
+            xi = x[i]
+            if not _hit(xi, kind, lo, hi, closed_lo, closed_hi):
+                continue
+            if kind == KIND_INTERVAL:
+                xi = min(max(xi, ll), ul)
+                x[i] = xi
+                if not _hit(xi, kind, lo, hi, closed_lo, closed_hi):
+                    continue
+            v = xi if use_x else replace
+            result[i] = v
+            mask[i] = v != v
+
+    @njit(cache=True, boundscheck=False, parallel=True)
+    def _fill_parallel(x, result, mask, kind, lo, hi, closed_lo, closed_hi, ll, ul, replace, use_x):  # type: ignore
+        # every chunk touches a disjoint slice of x and result, so no writes are shared between threads
+        n = x.shape[0]
+        for c in prange((n + PARALLEL_CHUNK - 1) // PARALLEL_CHUNK):
+            start = c * PARALLEL_CHUNK
+            end = min(start + PARALLEL_CHUNK, n)
+            _fill_serial(
+                x[start:end], result[start:end], mask[start:end], kind, lo, hi, closed_lo, closed_hi, ll, ul, replace, use_x
+            )
+
+    def _fill_kernel(x, result, mask, kind, lo, hi, closed_lo, closed_hi, ll, ul, replace, use_x):  # type: ignore
+        """Fill `result` slots flagged in `mask` wherever the selection applies, clearing `mask` for non-missing stores"""
+        if x.shape[0] < PARALLEL_THRESHOLD:
+            _fill_serial(x, result, mask, kind, lo, hi, closed_lo, closed_hi, ll, ul, replace, use_x)
+        else:
+            _fill_parallel(x, result, mask, kind, lo, hi, closed_lo, closed_hi, ll, ul, replace, use_x)
+
+    FILL_KERNEL = _fill_kernel
+
+    @njit(cache=True, boundscheck=False)
+    def _selection_set_serial(x, result, kind, lo, hi, closed_lo, closed_hi, replace, use_x, ll, ul):  # type: ignore
+        # x[i] is loaded once and tested against each selection in priority order until a slot is filled
+        for i in range(x.shape[0]):
+            xi = x[i]
+            for k in range(kind.shape[0]):
+                kk = kind[k]
+                hit = _hit(xi, kk, lo[k], hi[k], closed_lo[k], closed_hi[k])
+                if hit and kk == KIND_INTERVAL:
+                    xi = min(max(xi, ll), ul)
+                    x[i] = xi
+                    hit = _hit(xi, kk, lo[k], hi[k], closed_lo[k], closed_hi[k])
+                if not hit:
+                    continue
+                v = xi if use_x[k] else replace[k]
+                result[i] = v
+                if v == v:
+                    break
+
+    @njit(cache=True, boundscheck=False, parallel=True)
+    def _selection_set_parallel(x, result, kind, lo, hi, closed_lo, closed_hi, replace, use_x, ll, ul):  # type: ignore
+        n = x.shape[0]
+        for c in prange((n + PARALLEL_CHUNK - 1) // PARALLEL_CHUNK):
+            start = c * PARALLEL_CHUNK
+            end = min(start + PARALLEL_CHUNK, n)
+            _selection_set_serial(
+                x[start:end], result[start:end], kind, lo, hi, closed_lo, closed_hi, replace, use_x, ll, ul
+            )
+
+    def _selection_set_kernel(x, result, kind, lo, hi, closed_lo, closed_hi, replace, use_x, ll, ul):  # type: ignore
+        if x.shape[0] < PARALLEL_THRESHOLD:
+            _selection_set_serial(x, result, kind, lo, hi, closed_lo, closed_hi, replace, use_x, ll, ul)
+        else:
+            _selection_set_parallel(x, result, kind, lo, hi, closed_lo, closed_hi, replace, use_x, ll, ul)
+
+    SELECTION_SET_KERNEL = _selection_set_kernel
@@ -1,18 +1,56 @@
 from __future__ import annotations
 from pyboostcard.constants import *
+from pyboostcard import kernels
 
-from typing import Dict, Type, Tuple, Union, Callable, Optional, Any, cast
+from typing import Dict, List, Type, Tuple, Union, Callable, Optional, Any, cast
 from collections import namedtuple
 from abc import ABC, abstractmethod, abstractproperty
 from copy import deepcopy
+from functools import partial
+from itertools import groupby
 import numpy as np  # typing: ignore
-import operator as op
+import threading
 import json
 import re
 
 np.warnings.filterwarnings("ignore")
 
-Comparator = Callable[[np.ndarray, float], np.ndarray]
+Comparator = Callable[..., np.ndarray]
+IntervalTest = Callable[[np.ndarray, float, float], np.ndarray]
+
+
+class _Scratch(threading.local):
+    """Per-thread bool buffers reused by the NumPy transform path, keyed by shape then slot"""
+
+    NAN = 0  # missing-result mask built by FittedSelection.transform
+    MASK = 1  # selection mask combined with the missing-result mask
+    TMP = 2  # short-lived intermediates that never outlive a single step
+    COMPARE = 3  # second operand of Interval comparisons, which can run while TMP is held
+
+    # drop everything rather than grow without bound when many shapes are seen
+    MAX_SHAPES = 8
+    # only tile-sized buffers are pooled, larger ones are allocated per call so a thread never pins a full column
+    MAX_POOLED_SIZE = kernels.TILE_SIZE
+
+    def __init__(self) -> None:
+        self.buffers: Dict[Tuple[int, ...], List[np.ndarray]] = {}
+
+    def get(self, shape: Tuple[int, ...], slot: int) -> np.ndarray:
+        bufs = self.buffers.get(shape)
+        if bufs is not None and slot < len(bufs):
+            return bufs[slot]
+        if int(np.prod(shape)) > self.MAX_POOLED_SIZE:
+            return np.empty(shape, dtype=np.bool_)
+        if bufs is None:
+            if len(self.buffers) >= self.MAX_SHAPES:
+                self.buffers.clear()
+            bufs = self.buffers[shape] = []
+        while len(bufs) <= slot:
+            bufs.append(np.empty(shape, dtype=np.bool_))
+        return bufs[slot]
+
+
+_scratch = _Scratch()
 
 
 class Selection(ABC):
@@ -96,26 +134,212 @@ class FittedSelection:
         self.value = value
 
     def transform(self, x: np.ndarray, result: np.ndarray, clamp: Clamp) -> np.ndarray:
+        """Fill missing slots of result in place where the selection applies and return it"""
+        # earlier selections may have already filled every slot
+        if not kernels.has_nan(result):
+            return result
+
+        nan_mask = np.isnan(result, _scratch.get(result.shape, _Scratch.NAN))
+        return self.transform_with_mask(x, result, nan_mask, clamp)
+
+    def transform_with_mask(self, x: np.ndarray, result: np.ndarray, nan_mask: np.ndarray, clamp: Clamp) -> np.ndarray:
+        """Fill result in place where the selection applies and nan_mask is set, clearing nan_mask as slots are filled
+
+        nan_mask must start as np.isnan(result) and be shared by every selection writing to the same result,
+        so the missing-value scan happens once per pass instead of once per selection.
+        """
+        x = np.asarray(x)
+        if kernels.HAS_NUMBA and self._transform_fused(x, result, nan_mask, clamp):
+            return result
+
+        if kernels.HAS_NUMEXPR and isinstance(self.selection, Interval) and x.size >= kernels.NUMEXPR_THRESHOLD:
+            self._transform_numexpr(x, result, nan_mask, clamp)
+            return result
+
+        # f and tmp are per-thread scratch buffers, so neither may be kept past this call
+        f = _scratch.get(nan_mask.shape, _Scratch.MASK)
+        tmp = _scratch.get(nan_mask.shape, _Scratch.TMP)
+
         if isinstance(self.selection, Interval):
-            # f = np.isnan(result)
-            f = self.selection.in_selection(x) & np.isnan(result)
-            ## clamp when fitting intervals only?
-            #print(f"Clamping! {(clamp.ll, clamp.ul)}")
-            ## clamp x and then do the rest as normal...
-            #print(result)
-            x[f] = np.clip(x[f], clamp.ll, clamp.ul)
-            #print(x)
+            np.logical_and(self.selection.in_selection(x), nan_mask, f)
+            if f.any():
+                x[f] = np.clip(x[f], clamp.ll, clamp.ul)
+
+        if isinstance(self.selection, (Identity, Clamp)):
+            # always-true selections fill every open slot, so skip building and combining a mask of ones
+            np.copyto(f, nan_mask)
+        else:
+            np.logical_and(self.selection.in_selection(x), nan_mask, f)
+        if self.value is None:
+            replace = x
+            # passing through a missing x leaves the slot open for later selections
+            if not isinstance(self.selection, Interval):
+                np.isnan(x, tmp)
+                np.logical_not(tmp, tmp)
+                np.logical_and(f, tmp, f)
+        else:
+            replace = self.value
+
+        np.putmask(result, f, replace)
+        np.logical_not(f, tmp)
+        np.logical_and(nan_mask, tmp, nan_mask)
+        return result
+
+    def _transform_numexpr(self, x: np.ndarray, result: np.ndarray, nan_mask: np.ndarray, clamp: Clamp) -> None:
+        """Update result and nan_mask in place for an interval selection using numexpr"""
+        sel = cast(Interval, self.selection)
+        f = kernels.interval_mask_numexpr(x, nan_mask, sel._lo, sel._hi, sel.bounds)
 
-        replace = x if self.value is None else self.value
-        # make sure to only update output vector where filter is true AND result == np.nan
-        f = self.selection.in_selection(x) & np.isnan(result)
-        return np.where(f, replace, result)
+        # clipping against an unbounded clamp is a no-op, so only pay for it when the clamp is finite
+        if (clamp.ll > -np.inf or clamp.ul < np.inf) and f.any():
+            x[f] = np.clip(x[f], clamp.ll, clamp.ul)
+            f = kernels.interval_mask_numexpr(x, nan_mask, sel._lo, sel._hi, sel.bounds)
+
+        kernels.fill_numexpr(f, x, result, nan_mask, np.nan if self.value is None else self.value, self.value is None)
+
+    def _transform_fused(self, x: np.ndarray, result: np.ndarray, nan_mask: np.ndarray, clamp: Clamp) -> bool:
+        """Update result and nan_mask in place with a single-pass numba kernel, returns False if inputs are not supported"""
+        xa = np.asarray(x)
+        for a in (xa, result):
+            if a.dtype != np.float64 or not a.flags.c_contiguous or not a.flags.writeable:
+                return False
+        if not nan_mask.flags.c_contiguous or not xa.shape == result.shape == nan_mask.shape:
+            return False
+
+        sel = self.selection
+        lo, hi = -np.inf, np.inf
+        closed_lo = closed_hi = False
+        if isinstance(sel, Interval):
+            kind = kernels.KIND_INTERVAL
+            lo, hi = sel._lo, sel._hi
+            closed_lo, closed_hi = sel.bounds
+        elif isinstance(sel, Override):
+            kind = kernels.KIND_OVERRIDE
+            lo = hi = sel.override
+        elif isinstance(sel, Missing):
+            kind = kernels.KIND_MISSING
+        else:
+            kind = kernels.KIND_ALWAYS
+
+        use_x = self.value is None
+        replace = np.nan if use_x else self.value
+        kernels.FILL_KERNEL(
+            xa.reshape(-1),
+            result.reshape(-1),
+            nan_mask.reshape(-1),
+            kind,
+            float(lo),
+            float(hi),
+            bool(closed_lo),
+            bool(closed_hi),
+            float(clamp.ll),
+            float(clamp.ul),
+            float(replace),
+            use_x,
+        )
+        return True
 
     @property
     def sort_value(self) -> Tuple[int, int, float]:
         return self.selection.sort_value
 
 
+class SelectionSet:
+    """Ordered fitted selections stored as parallel arrays so they can be applied in a single sweep over x"""
+
+    def __init__(self, selections: List[FittedSelection]):
+        self.selections = selections
+
+        n = len(selections)
+        self.kind = np.full(n, kernels.KIND_ALWAYS, dtype=np.int8)
+        self.lo = np.full(n, -np.inf)
+        self.hi = np.full(n, np.inf)
+        self.closed_lo = np.zeros(n, dtype=np.bool_)
+        self.closed_hi = np.zeros(n, dtype=np.bool_)
+        self.replace = np.full(n, np.nan)
+        self.use_x = np.zeros(n, dtype=np.bool_)
+
+        for k, fs in enumerate(selections):
+            sel = fs.selection
+            if isinstance(sel, Interval):
+                self.kind[k] = kernels.KIND_INTERVAL
+                self.lo[k], self.hi[k] = sel._lo, sel._hi
+                self.closed_lo[k], self.closed_hi[k] = sel.bounds
+            elif isinstance(sel, Override):
+                self.kind[k] = kernels.KIND_OVERRIDE
+                self.lo[k] = sel.override
+            elif isinstance(sel, Missing):
+                self.kind[k] = kernels.KIND_MISSING
+
+            if fs.value is None:
+                self.use_x[k] = True
+            else:
+                self.replace[k] = fs.value
+
+        # overrides match disjoint values, so a run of them can be applied together with a single np.isin
+        self._steps: List[Union[FittedSelection, Tuple[np.ndarray, np.ndarray]]] = []
+        for kind, group in groupby(range(n), key=lambda k: self.kind[k]):
+            idx = np.array(list(group))
+            if kind == kernels.KIND_OVERRIDE and len(idx) > 1:
+                idx = idx[np.argsort(self.lo[idx], kind="stable")]
+                self._steps.append((self.lo[idx], idx))
+            else:
+                self._steps.extend(selections[k] for k in idx)
+
+    def __len__(self) -> int:
+        return len(self.selections)
+
+    def transform(self, x: np.ndarray, clamp: Clamp) -> np.ndarray:
+        """Return a new array filled by the first selection, in order, that applies to each value of x"""
+        x = np.asarray(x)
+        result = np.full_like(x, np.nan, dtype="float")
+
+        if kernels.HAS_NUMBA and x.dtype == np.float64 and x.flags.c_contiguous and x.flags.writeable:
+            kernels.SELECTION_SET_KERNEL(
+                x.reshape(-1),
+                result.reshape(-1),
+                self.kind,
+                self.lo,
+                self.hi,
+                self.closed_lo,
+                self.closed_hi,
+                self.replace,
+                self.use_x,
+                float(clamp.ll),
+                float(clamp.ul),
+            )
+            return result
+
+        # computed once and kept in sync by each selection as it fills result
+        nan_mask = np.isnan(result)
+
+        # run every selection over one cache-sized block before moving on so each pass re-reads from L2, not RAM
+        for start in range(0, len(x), kernels.TILE_SIZE):
+            end = start + kernels.TILE_SIZE
+            xt, rt, mt = x[start:end], result[start:end], nan_mask[start:end]
+            for step in self._steps:
+                # earlier selections may have already filled every slot
+                if not kernels.has_nan(rt):
+                    break
+                if isinstance(step, FittedSelection):
+                    step.transform_with_mask(xt, rt, mt, clamp)
+                else:
+                    self._transform_overrides(xt, rt, mt, *step)
+
+        return result
+
+    def _transform_overrides(
+        self, x: np.ndarray, result: np.ndarray, nan_mask: np.ndarray, values: np.ndarray, idx: np.ndarray
+    ) -> None:
+        """Fill result in place for a group of overrides, values must be sorted with idx their selection positions"""
+        f = np.isin(x, values)
+        f &= nan_mask
+        xf = x[f]
+        k = idx[np.searchsorted(values, xf)]
+        result[f] = np.where(self.use_x[k], xf, self.replace[k])
+        nan_mask &= ~f
+
+
 class Identity(Selection):
     """Selection responsible for only passing through -- no constraint in other words"""
 
@@ -127,7 +351,7 @@ class Identity(Selection):
 
     def in_selection(self, x: np.ndarray) -> np.ndarray:
         """Always return true for identity selections"""
-        return np.full_like(x, True, dtype="bool")
+        return np.ones(np.shape(x), dtype=np.bool_)
 
     def __repr__(self) -> str:
         return "I"
@@ -146,37 +370,75 @@ class Clamp(Selection):
 
     def in_selection(self, x: np.ndarray) -> np.ndarray:
         """Always return true for clamp selections"""
-        return np.full_like(x, True, dtype="bool")
+        return np.ones(np.shape(x), dtype=np.bool_)
 
     def __repr__(self) -> str:
         return "C"
 
 
+def _compare(x: np.ndarray, lo: float, hi: float, ltest: Comparator, rtest: Comparator) -> np.ndarray:
+    """Apply both bound comparisons into preallocated ufunc outputs so the returned mask is the only allocation"""
+    # strided input would push the comparisons off NumPy's contiguous SIMD loops, so pay for one copy up front.
+    # ascontiguousarray alone would also promote 0-d input to 1-d, so only copy when the layout needs it
+    x = np.asarray(x)
+    if not x.flags.c_contiguous:
+        x = np.ascontiguousarray(x)
+    mask = np.empty(x.shape, dtype=np.bool_)
+    # the mask is returned to the caller, only the intermediate can come from the scratch pool
+    tmp = _scratch.get(x.shape, _Scratch.COMPARE)
+    ltest(x, lo, mask)
+    rtest(x, hi, tmp)
+    np.logical_and(mask, tmp, mask)
+    return mask
+
+
 class Interval(Selection):
     """Constrain interval between values with optional inclusivity and montonicity"""
 
     priority = 0
 
     testmap: Dict[Tuple[bool, bool], Tuple[Comparator, Comparator]] = {
-        (False, False): (op.gt, op.lt),
-        (False, True): (op.gt, op.le),
-        (True, False): (op.ge, op.lt),
-        (True, True): (op.ge, op.le),
+        (False, False): (np.greater, np.less),
+        (False, True): (np.greater, np.less_equal),
+        (True, False): (np.greater_equal, np.less),
+        (True, True): (np.greater_equal, np.less_equal),
+    }
+
+    # bounds-specialized tests bound once so in_selection is a single call with no lookups,
+    # partials of a module-level function keep intervals picklable
+    _tests: Dict[Tuple[bool, bool], IntervalTest] = {
+        k: partial(_compare, ltest=ltest, rtest=rtest) for k, (ltest, rtest) in testmap.items()
     }
 
     def __init__(self, values: Tuple[float, float], bounds: Tuple[bool, bool], order: int = 0, mono: int = 0):
         """Bounds are tuple of bools where each indicates closed boundary"""
         super().__init__(order)
-        self.values = tuple(sorted(values))
+        self.values = values
         self.bounds = Bounds(*bounds)
         self.mono = mono
+        self._test = self._tests[self.bounds]
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        # rebind the shared test so unpickled intervals compare equal to freshly built ones
+        self._test = self._tests[self.bounds]
 
     def __repr__(self) -> str:
         return "i"
 
+    @property
+    def values(self) -> Tuple[float, float]:
+        return self._lo, self._hi
+
+    @values.setter
+    def values(self, values: Tuple[float, float]) -> None:
+        # stored as separate floats so the hot path avoids tuple indexing
+        a, b = sorted(values)
+        self._lo, self._hi = float(a), float(b)
+
     @property
     def sort_value(self) -> Tuple[int, int, float]:
-        return self.priority, self.order, self.values[0]
+        return self.priority, self.order, self._lo
 
     @property
     def mono(self) -> int:
@@ -190,9 +452,8 @@ class Interval(Selection):
             self._mono = value
 
     def in_selection(self, x: np.ndarray) -> np.ndarray:
-        z = np.ma.masked_invalid(x)
-        ltest, rtest = self.testmap[self.bounds]
-        return ltest(z, self.values[0]) & rtest(z, self.values[1])
+        # comparisons against np.nan are always False, so missing values fall out without a mask
+        return self._test(x, self._lo, self._hi)
 
     # def _clip(self, clamp: Clamp) -> None:
     #     """clip the min max rage of the interval to be within the clamped values"""
@@ -214,7 +475,8 @@ class Override(Selection):
         return "O"
 
     def in_selection(self, x: np.ndarray) -> np.ndarray:
-        return (x == self.override) & ~np.isnan(x)
+        # x == value is already False wherever x is np.nan
+        return x == self.override
 
 
 class Missing(Selection):
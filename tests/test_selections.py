@@ -1,7 +1,10 @@
 # type: ignore
 
 from pyboostcard.selections import *
+from pyboostcard import kernels
 import numpy as np
+import pickle
+import pytest
 
 
 class TestIntervalSelection:
@@ -24,6 +27,28 @@ class TestIntervalSelection:
         i = Interval((0.0, 4.0), (True, False))
         np.testing.assert_equal(i.in_selection(self.x), np.array([True, True, True, True, False]))
 
+    def test_interval_pickle(self):
+        for bounds in Interval.testmap:
+            i = Interval((0.0, 4.0), bounds)
+            j = pickle.loads(pickle.dumps(i))
+            assert j._test is i._test
+            np.testing.assert_equal(j.in_selection(np.arange(5.0)), i.in_selection(np.arange(5.0)))
+
+    def test_interval_strided(self):
+        i = Interval((0.0, 4.0), (True, False))
+        x = np.arange(10.0).reshape(5, 2)[:, 0]
+        np.testing.assert_equal(i.in_selection(x), np.array([True, True, False, False, False]))
+
+    def test_interval_shape(self):
+        i = Interval((0.0, 1.0), (True, True))
+        assert i.in_selection(np.float64(0.5)).shape == ()
+        assert i.in_selection(np.zeros((2, 3))).shape == (2, 3)
+        assert i.in_selection(np.zeros((4, 6))[::2, ::3]).shape == (2, 2)
+
+    def test_interval_missing(self):
+        i = Interval((-np.inf, np.inf), (True, True))
+        np.testing.assert_equal(i.in_selection(np.array([np.nan, 0.0, np.nan])), np.array([False, True, False]))
+
 
 class TestOverrideSelection:
     def test_override(self):
@@ -31,6 +56,7 @@ class TestOverrideSelection:
         np.testing.assert_equal(z.in_selection(np.array([-1.0])), np.array([True]))
         np.testing.assert_equal(z.in_selection(np.array([0.0])), np.array([False]))
         np.testing.assert_equal(z.in_selection(np.array([0.0, -1.0])), np.array([False, True]))
+        np.testing.assert_equal(z.in_selection(np.array([np.nan, -1.0])), np.array([False, True]))
 
 
 class TestMissingSelection:
@@ -47,6 +73,125 @@ class TestIdentitySelection:
         np.testing.assert_equal(z.in_selection(np.array([0, 1, 2, 3])), np.array([True, True, True, True]))
 
 
+class TestFittedSelection:
+
+    clamp = Clamp(-np.inf, np.inf)
+
+    def test_transform_with_mask(self):
+        x = np.array([np.nan, -1.0, 0.0, 1.0])
+        result = np.full_like(x, np.nan)
+        nan_mask = np.isnan(result)
+        FittedSelection(Missing(), 5.0).transform_with_mask(x, result, nan_mask, self.clamp)
+        FittedSelection(Interval((-1.0, 0.0), (True, True)), None).transform_with_mask(x, result, nan_mask, self.clamp)
+        np.testing.assert_equal(result, np.array([5.0, -1.0, 0.0, np.nan]))
+        np.testing.assert_equal(nan_mask, np.isnan(result))
+
+    def test_transform_in_place(self):
+        x = np.array([np.nan, -1.0, 2.0])
+        result = np.array([np.nan, np.nan, 3.0])
+        out = FittedSelection(Override(-1.0), 4.0).transform(x, result, self.clamp)
+        assert out is result
+        np.testing.assert_equal(result, np.array([np.nan, 4.0, 3.0]))
+
+    def test_scratch_pool(self):
+        from pyboostcard.selections import _Scratch
+        scratch = _Scratch()
+        small, large = (_Scratch.MAX_POOLED_SIZE,), (_Scratch.MAX_POOLED_SIZE + 1,)
+        assert scratch.get(small, _Scratch.TMP) is scratch.get(small, _Scratch.TMP)
+        assert scratch.get(small, _Scratch.TMP) is not scratch.get(small, _Scratch.COMPARE)
+        assert scratch.get(large, _Scratch.TMP) is not scratch.get(large, _Scratch.TMP)
+        assert list(scratch.buffers) == [small]
+
+    def test_clipped_input_numpy(self, monkeypatch):
+        # clipping x in place must be seen by every later selection that tests the same array
+        monkeypatch.setattr(kernels, "HAS_NUMBA", False)
+        monkeypatch.setattr(kernels, "HAS_NUMEXPR", False)
+        a = Interval((-np.inf, -5.0), (True, True))
+        b = Interval((-5.0, np.inf), (False, True))
+        clamp = Clamp(-4.0, 4.0)
+        x = np.full(2000, -10.0)
+        for _ in range(2):
+            result = np.full_like(x, np.nan)
+            FittedSelection(b, 1.0).transform(x, result, clamp)
+            FittedSelection(a, None).transform(x, result, clamp)
+        np.testing.assert_equal(result, np.ones_like(x))
+
+    def test_parallel_kernel(self, monkeypatch):
+        pytest.importorskip("numba")
+        x = np.random.default_rng(0).normal(size=40_000)
+        x[::7] = np.nan
+        clamp = Clamp(-0.5, 0.5)
+        for fitted in [
+            FittedSelection(Interval((-1.0, 1.0), (True, False)), None),
+            FittedSelection(Missing(), 3.0),
+            FittedSelection(Identity(), None),
+        ]:
+            monkeypatch.setattr(kernels, "PARALLEL_THRESHOLD", 0)
+            expected_x, parallel_x = x.copy(), x.copy()
+            parallel = fitted.transform(parallel_x, np.full_like(x, np.nan), clamp)
+            monkeypatch.setattr(kernels, "HAS_NUMBA", False)
+            monkeypatch.setattr(kernels, "HAS_NUMEXPR", False)
+            expected = fitted.transform(expected_x, np.full_like(x, np.nan), clamp)
+            monkeypatch.undo()
+            np.testing.assert_equal(parallel, expected)
+            np.testing.assert_equal(parallel_x, expected_x)
+
+    @pytest.mark.parametrize("clamp", [Clamp(-0.5, 0.5), Clamp(-np.inf, np.inf)])
+    def test_numexpr(self, monkeypatch, clamp):
+        pytest.importorskip("numexpr")
+        x = np.random.default_rng(0).normal(size=kernels.NUMEXPR_THRESHOLD + 1_000)
+        x[::7] = np.nan
+        monkeypatch.setattr(kernels, "HAS_NUMBA", False)
+        for fitted in [
+            FittedSelection(Interval((-1.0, 1.0), (True, False)), None),
+            FittedSelection(Interval((0.0, np.inf), (False, False)), 2.0),
+        ]:
+            monkeypatch.setattr(kernels, "HAS_NUMEXPR", True)
+            expected_x, numexpr_x = x.copy(), x.copy()
+            numexpr = fitted.transform(numexpr_x, np.full_like(x, np.nan), clamp)
+            monkeypatch.setattr(kernels, "HAS_NUMEXPR", False)
+            expected = fitted.transform(expected_x, np.full_like(x, np.nan), clamp)
+            np.testing.assert_equal(numexpr, expected)
+            np.testing.assert_equal(numexpr_x, expected_x)
+
+
+class TestSelectionSet:
+    def test_transform(self):
+        x = np.array([np.nan, -1.0, 2.0, 0.5, 3.0])
+        fitted = [
+            FittedSelection(Override(-1.0), 10.0),
+            FittedSelection(Override(2.0), 20.0),
+            FittedSelection(Missing(), 30.0),
+            FittedSelection(Interval((-np.inf, np.inf), (True, True)), None),
+        ]
+        result = SelectionSet(fitted).transform(x, Clamp(-np.inf, np.inf))
+        np.testing.assert_equal(result, np.array([30.0, 10.0, 20.0, 0.5, 3.0]))
+
+    # the larger size spans several NumPy-path tiles and ends on a partial one
+    @pytest.mark.parametrize("size", [1_000, 2 * kernels.TILE_SIZE + 17_857])
+    def test_numpy_fallback(self, monkeypatch, size):
+        pytest.importorskip("numba")
+        rng = np.random.default_rng(0)
+        x = rng.choice([-1.0, 2.0, 5.0, np.nan, 0.25], size=size)
+        x[::3] = rng.normal(size=x[::3].shape)
+        fitted = [
+            FittedSelection(Override(-1.0), 10.0),
+            FittedSelection(Override(5.0), None),
+            FittedSelection(Override(2.0), 20.0),
+            FittedSelection(Missing(), 30.0),
+            FittedSelection(Interval((-1.0, 1.0), (False, True)), None),
+            FittedSelection(Interval((1.0, np.inf), (False, False)), 40.0),
+        ]
+        clamp = Clamp(-0.5, 0.5)
+        expected_x, fallback_x = x.copy(), x.copy()
+        expected = SelectionSet(fitted).transform(expected_x, clamp)
+        monkeypatch.setattr(kernels, "HAS_NUMBA", False)
+        monkeypatch.setattr(kernels, "HAS_NUMEXPR", False)
+        fallback = SelectionSet(fitted).transform(fallback_x, clamp)
+        np.testing.assert_equal(fallback, expected)
+        np.testing.assert_equal(fallback_x, expected_x)
+
+
 class TestStaticMethods:
     def test_bounds_from_string(self):
         assert Selection.bounds_from_string("[]") == (True, True)